@@ -1,34 +1,117 @@
 from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional
+from typing import List, Optional, Tuple
 import uuid
 from datetime import datetime, timezone
 import time
+import asyncio
+import threading
+import json
+import hashlib
+import re
+from contextlib import contextmanager
+from functools import lru_cache
 from emergentintegrations.emergent import (
     create_text_embedding
 )
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+import redis.asyncio as aioredis
+
+try:
+    import faiss
+except ImportError:  # FAISS is optional
+    faiss = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
 # Emergent LLM Key
 EMERGENT_KEY = os.environ.get('EMERGENT_LLM_KEY', 'sk-emergent-a45B89aAc9459F1977')
 
+# Redis cache (optional, shared across workers)
+REDIS_URL = os.environ.get('REDIS_URL')
+redis_client = aioredis.from_url(REDIS_URL) if REDIS_URL else None
+EMBEDDING_CACHE_TTL = 86400
+SEARCH_CACHE_TTL = 300
+SEARCH_RECENT_PREFIX = "search:recent:"
+CATALOG_GENERATION_KEY = "products:gen"
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_SIZE = 64
+INVALIDATE_CHANNEL = "products:invalidate"
+WORKER_ID = uuid.uuid4().hex
+
+CURSOR_BATCH_SIZE = 25
+
+class ReadWriteLock:
+    """Threading lock that admits many readers or one writer; waiting writers block new readers"""
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writers_waiting = 0
+        self._writing = False
+    
+    @contextmanager
+    def reading(self):
+        with self._cond:
+            while self._writing or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+    
+    @contextmanager
+    def writing(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+# In-memory product embedding matrix; new products are appended, other changes force a reload
+_EMB_LOADED = False
+_EMB_MATRIX: Optional[np.ndarray] = None  # None while the FAISS index holds the vectors
+_EMB_META: List[dict] = []
+_EMB_META_FIELDS = ("id", "name", "description", "vibe_tags", "category", "image_url")
+_EMB_INDEX = None
+_EMB_VERSION = 0
+_EMB_GENERATION: Optional[int] = None  # catalog generation the matrix was loaded at
+_EMB_LOCK = asyncio.Lock()  # per worker process; each worker keeps its own matrix
+_EMB_RELOAD: Optional[asyncio.Task] = None
+_INDEX_LOCK = ReadWriteLock()  # FAISS indexes can be searched concurrently but not while adding
+_invalidation_task: Optional[asyncio.Task] = None
+SIMILARITY_BLOCK_ROWS = 64
+FAISS_MIN_PRODUCTS = 10000
+
 # Create the main app
-app = FastAPI(title="Vibe Matcher - Fashion Recommendation System")
+app = FastAPI(
+    title="Vibe Matcher - Fashion Recommendation System",
+    default_response_class=ORJSONResponse
+)
 api_router = APIRouter(prefix="/api")
 
 logging.basicConfig(level=logging.INFO)
@@ -74,24 +157,357 @@ class QueryMetrics(BaseModel):
     top_score: Optional[float]
     timestamp: datetime
 
-def generate_embedding(text: str) -> List[float]:
-    """Generate embedding using Emergent LLM Key"""
+def _embed_text(product: ProductCreate) -> str:
+    """Build the text embedded for a product"""
+    return f"{product.name}. {product.description}. Vibes: {', '.join(product.vibe_tags)}"
+
+@lru_cache(maxsize=4096)
+def generate_embedding(text: str) -> np.ndarray:
+    """Generate embedding using Emergent LLM Key, cached per text as a read-only float32 array"""
     try:
         embedding = create_text_embedding(
             text=text,
             model="text-embedding-3-small",
             api_key=EMERGENT_KEY
         )
+        embedding = np.asarray(embedding, dtype=np.float32)
+        embedding.setflags(write=False)
         return embedding
     except Exception as e:
         logger.error(f"Error generating embedding: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Embedding generation failed: {str(e)}")
 
-def calculate_cosine_similarity(embedding1: List[float], embedding2: List[float]) -> float:
-    """Calculate cosine similarity between two embeddings"""
-    vec1 = np.array(embedding1).reshape(1, -1)
-    vec2 = np.array(embedding2).reshape(1, -1)
-    return float(cosine_similarity(vec1, vec2)[0][0])
+def normalize_embedding(embedding: List[float]) -> List[float]:
+    """L2-normalize an embedding so cosine similarity reduces to a dot product"""
+    vec = np.asarray(embedding, dtype=np.float32)
+    return (vec / (np.linalg.norm(vec) + 1e-12)).tolist()
+
+def encode_embedding(embedding: List[float]) -> bytes:
+    """Pack an embedding as raw float16 bytes for storage"""
+    return np.asarray(embedding, dtype=np.float16).tobytes()
+
+def decode_embedding(value) -> np.ndarray:
+    """Unpack a stored embedding, accepting legacy float arrays as well as float16 bytes"""
+    if isinstance(value, bytes):
+        return np.frombuffer(value, dtype=np.float16)
+    return np.asarray(value, dtype=np.float16)
+
+def invalidate_embedding_matrix():
+    """Drop the in-memory embedding matrix after the product catalog changes"""
+    global _EMB_LOADED, _EMB_MATRIX, _EMB_INDEX, _EMB_VERSION
+    _EMB_VERSION += 1
+    _EMB_LOADED = False
+    _EMB_MATRIX = None
+    _EMB_INDEX = None
+
+def build_search_index(matrix: np.ndarray):
+    """Build an exact FAISS inner-product index, stored in half precision, for large catalogs
+    if FAISS is installed"""
+    if faiss is None or matrix.shape[0] < FAISS_MIN_PRODUCTS:
+        return None
+    index = faiss.IndexScalarQuantizer(matrix.shape[1], faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+    index.add(matrix.astype(np.float32))
+    return index
+
+def add_to_search_index(index, vectors: np.ndarray):
+    """Add new rows to a live FAISS index"""
+    with _INDEX_LOCK.writing():
+        index.add(vectors.astype(np.float32))
+
+async def add_to_embedding_matrix(products: List[dict], vectors: np.ndarray, generation: Optional[int]):
+    """Append new products to the in-memory matrix and FAISS index instead of rebuilding them"""
+    global _EMB_MATRIX, _EMB_META, _EMB_INDEX, _EMB_GENERATION, _EMB_VERSION
+    async with _EMB_LOCK:
+        if not _EMB_LOADED:
+            # Nothing loaded yet; the next search loads the full catalog
+            return
+        if generation is not None:
+            if _EMB_GENERATION is not None and _EMB_GENERATION >= generation:
+                # Loaded after this write, so the products are already in the matrix
+                return
+            if _EMB_GENERATION != generation - 1:
+                # An earlier write was missed; the next search reloads in the background
+                # while the current matrix keeps serving
+                _EMB_GENERATION = None
+                return
+        
+        known_ids = {product['id'] for product in _EMB_META}
+        new_rows = [i for i, product in enumerate(products) if product['id'] not in known_ids]
+        if new_rows:
+            vectors = vectors[new_rows]
+            index, matrix = _EMB_INDEX, None
+            if index is not None:
+                await asyncio.to_thread(add_to_search_index, index, vectors)
+            else:
+                if _EMB_MATRIX.shape[0]:
+                    matrix = np.ascontiguousarray(np.concatenate([_EMB_MATRIX, vectors]))
+                else:
+                    matrix = np.ascontiguousarray(vectors)
+                index = await asyncio.to_thread(build_search_index, matrix)
+                if index is not None:
+                    matrix = None
+            _EMB_MATRIX, _EMB_META, _EMB_INDEX = matrix, _EMB_META + [products[i] for i in new_rows], index
+            # A reload that started before these products were inserted must not replace them
+            _EMB_VERSION += 1
+        _EMB_GENERATION = generation
+
+def _embedding_matrix_is_current(generation: Optional[int]) -> bool:
+    if not _EMB_LOADED:
+        return False
+    return generation is None or (_EMB_GENERATION is not None and _EMB_GENERATION >= generation)
+
+async def _reload_embedding_matrix(generation: Optional[int]) -> Tuple[Optional[np.ndarray], List[dict], Optional[object], Optional[int]]:
+    """Load the matrix and FAISS index from Mongo without holding _EMB_LOCK, then swap them in"""
+    global _EMB_LOADED, _EMB_MATRIX, _EMB_META, _EMB_INDEX, _EMB_GENERATION
+    version = _EMB_VERSION
+    products, embeddings = [], []
+    projection = {"_id": 0, "embedding": 1, **{field: 1 for field in _EMB_META_FIELDS}}
+    cursor = db.products.find({"embedding": {"$ne": None}}, projection).batch_size(CURSOR_BATCH_SIZE)
+    async for product in cursor:
+        embeddings.append(decode_embedding(product['embedding']))
+        products.append({field: product.get(field) for field in _EMB_META_FIELDS})
+    if embeddings:
+        matrix = np.ascontiguousarray(np.stack(embeddings))
+    else:
+        matrix = np.empty((0, 0), dtype=np.float16)
+    index = await asyncio.to_thread(build_search_index, matrix)
+    if index is not None:
+        # The index keeps its own half-precision copy; don't hold a second one
+        matrix = None
+    
+    async with _EMB_LOCK:
+        # Don't keep a matrix that was invalidated or appended to while it was loading
+        if version == _EMB_VERSION:
+            _EMB_MATRIX, _EMB_META, _EMB_INDEX, _EMB_GENERATION = matrix, products, index, generation
+            _EMB_LOADED = True
+    return matrix, products, index, generation
+
+async def get_embedding_matrix(generation: Optional[int]) -> Tuple[Optional[np.ndarray], List[dict], Optional[object], Optional[int]]:
+    """Get the (N, d) float16 product embedding matrix (None when a FAISS index holds the
+    vectors instead), its parallel list of product metadata (no embeddings), the optional
+    index and the catalog generation they reflect, reloading them if the catalog has moved
+    past that generation"""
+    global _EMB_RELOAD
+    if _embedding_matrix_is_current(generation):
+        return _EMB_MATRIX, _EMB_META, _EMB_INDEX, _EMB_GENERATION
+    
+    # One reload at a time per worker; concurrent searches share it
+    if _EMB_RELOAD is None or _EMB_RELOAD.done():
+        _EMB_RELOAD = asyncio.create_task(_reload_embedding_matrix(generation))
+    reload = _EMB_RELOAD
+    
+    if _EMB_LOADED:
+        # Another worker changed the catalog; keep serving the previous matrix until the
+        # reload lands. Results are cached under the old generation, so they aren't reused.
+        return _EMB_MATRIX, _EMB_META, _EMB_INDEX, _EMB_GENERATION
+    return await asyncio.shield(reload)
+
+def compute_similarities(matrix: np.ndarray, query_vec: np.ndarray) -> np.ndarray:
+    """Dot a float16 embedding matrix with a float32 query, upcasting one block of rows at a time"""
+    similarities = np.empty(matrix.shape[0], dtype=np.float32)
+    for start in range(0, matrix.shape[0], SIMILARITY_BLOCK_ROWS):
+        block = matrix[start:start + SIMILARITY_BLOCK_ROWS].astype(np.float32)
+        similarities[start:start + SIMILARITY_BLOCK_ROWS] = block @ query_vec
+    return similarities
+
+def rank_products(query_vec: np.ndarray, matrix: Optional[np.ndarray], products: List[dict], index,
+                  limit: int, threshold: float) -> List[dict]:
+    """Rank products against a normalized query and return the top matches above threshold"""
+    # Embeddings are stored L2-normalized, so cosine similarity is a dot product
+    if index is not None:
+        # Large catalogs: exact top-k from the FAISS index
+        with _INDEX_LOCK.reading():
+            scores, ids = index.search(query_vec.reshape(1, -1), limit)
+        # Rows added to the index after this search's product list was taken are skipped
+        keep = (ids[0] >= 0) & (ids[0] < len(products)) & (scores[0] >= threshold)
+        top_idx, top_scores = ids[0][keep], scores[0][keep]
+    else:
+        similarities = compute_similarities(matrix, query_vec)
+        
+        # Drop products below threshold, then select top matches without sorting every product
+        candidates = np.flatnonzero(similarities >= threshold)
+        if len(candidates) > limit:
+            top = np.argpartition(-similarities[candidates], limit - 1)[:limit]
+            candidates = candidates[top]
+        top_idx = candidates[np.argsort(-similarities[candidates])]
+        top_scores = similarities[top_idx]
+    
+    # Only materialize result dicts for the selected products
+    results = []
+    for i, score in zip(top_idx, top_scores):
+        product = products[i]
+        results.append({
+            "id": product['id'],
+            "name": product['name'],
+            "description": product['description'],
+            "vibe_tags": product['vibe_tags'],
+            "category": product['category'],
+            "image_url": product['image_url'],
+            "similarity_score": round(float(score), 4)
+        })
+    return results
+
+def _normalize_query(text: str) -> str:
+    """Collapse case and whitespace so trivially different queries share cache entries"""
+    return re.sub(r"\s+", " ", text.strip().lower())
+
+def _cache_key(text: str) -> str:
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+async def get_query_embedding(text: str) -> np.ndarray:
+    """Get a query embedding, shared across workers through Redis when configured"""
+    key = f"emb:{_cache_key(text)}"
+    if redis_client is not None:
+        try:
+            cached = await redis_client.get(key)
+            if cached is not None:
+                return np.frombuffer(cached, dtype=np.float32)
+        except Exception as e:
+            logger.warning(f"Redis embedding lookup failed: {str(e)}")
+    
+    embedding = await asyncio.to_thread(generate_embedding, text)
+    if redis_client is not None:
+        try:
+            await redis_client.set(key, embedding.tobytes(), ex=EMBEDDING_CACHE_TTL)
+        except Exception as e:
+            logger.warning(f"Redis embedding store failed: {str(e)}")
+    return embedding
+
+async def get_catalog_generation() -> Optional[int]:
+    """Get the shared catalog generation, bumped on every product write"""
+    if redis_client is None:
+        # Without Redis, workers share the generation through a Mongo document
+        state = await db.catalog_state.find_one({"_id": CATALOG_GENERATION_KEY})
+        return state['generation'] if state else 0
+    try:
+        return int(await redis_client.get(CATALOG_GENERATION_KEY) or 0)
+    except Exception as e:
+        logger.warning(f"Redis generation lookup failed: {str(e)}")
+        return None
+
+async def get_cached_search(vibe: str, query_vec: np.ndarray, limit: int, threshold: float,
+                            generation: Optional[int]) -> Optional[List[dict]]:
+    """Look up cached search results for the same or a near-duplicate query"""
+    if redis_client is None or generation is None:
+        return None
+    try:
+        params = f"{generation}|{limit}|{threshold}"
+        cached = await redis_client.get(f"search:{_cache_key(vibe)}|{params}")
+        if cached is not None:
+            return json.loads(cached)
+        
+        # Fall back to the closest recent query searched with the same parameters
+        entries = await redis_client.lrange(f"{SEARCH_RECENT_PREFIX}{params}", 0, -1)
+        if entries:
+            # Each entry is a 32-char hex query key followed by the float16 query embedding
+            vectors = np.frombuffer(b"".join(entry[32:] for entry in entries), dtype=np.float16)
+            scores = vectors.reshape(len(entries), -1).astype(np.float32) @ query_vec
+            best = int(np.argmax(scores))
+            if scores[best] >= SEMANTIC_CACHE_THRESHOLD:
+                cached = await redis_client.get(f"search:{entries[best][:32].decode()}|{params}")
+                if cached is not None:
+                    return json.loads(cached)
+    except Exception as e:
+        logger.warning(f"Redis search lookup failed: {str(e)}")
+    return None
+
+async def cache_search(vibe: str, query_vec: np.ndarray, limit: int, threshold: float,
+                       results: List[dict], generation: Optional[int]):
+    """Cache search results, computed at the given catalog generation, along with the
+    query embedding for near-duplicate lookups"""
+    if redis_client is None or generation is None:
+        return
+    try:
+        key = _cache_key(vibe)
+        params = f"{generation}|{limit}|{threshold}"
+        recent_key = f"{SEARCH_RECENT_PREFIX}{params}"
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.set(f"search:{key}|{params}", json.dumps(results), ex=SEARCH_CACHE_TTL)
+            # Newest first; trimming drops the oldest queries beyond the cap
+            pipe.lpush(recent_key, key.encode() + query_vec.astype(np.float16).tobytes())
+            pipe.ltrim(recent_key, 0, SEMANTIC_CACHE_SIZE - 1)
+            pipe.expire(recent_key, SEARCH_CACHE_TTL)
+            await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Redis search store failed: {str(e)}")
+
+async def bump_catalog_generation() -> Optional[int]:
+    """Move the catalog to a new generation so results cached for older ones are never served
+    and other workers reload their embedding matrix"""
+    if redis_client is None:
+        state = await db.catalog_state.find_one_and_update(
+            {"_id": CATALOG_GENERATION_KEY},
+            {"$inc": {"generation": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return state['generation']
+    try:
+        return await redis_client.incr(CATALOG_GENERATION_KEY)
+    except Exception as e:
+        logger.warning(f"Redis generation bump failed: {str(e)}")
+        return None
+
+async def publish_catalog_change(generation: Optional[int], product_ids: Optional[List[str]] = None):
+    """Tell other workers about a catalog write: either the ids of added products or,
+    without ids, that their embedding matrix must be dropped"""
+    if redis_client is None:
+        return
+    message = {"worker": WORKER_ID, "generation": generation, "product_ids": product_ids}
+    try:
+        await redis_client.publish(INVALIDATE_CHANNEL, json.dumps(message))
+    except Exception as e:
+        logger.warning(f"Redis invalidation publish failed: {str(e)}")
+
+async def invalidate_product_caches():
+    """Invalidate every product-derived cache and tell other workers to drop theirs"""
+    invalidate_embedding_matrix()
+    generation = await bump_catalog_generation()
+    await publish_catalog_change(generation)
+
+async def add_products_to_caches(products: List[Product]):
+    """Append newly inserted products to this worker's matrix and tell other workers to do the same"""
+    generation = await bump_catalog_generation()
+    meta = [{field: getattr(product, field) for field in _EMB_META_FIELDS} for product in products]
+    vectors = np.stack([np.asarray(product.embedding, dtype=np.float16) for product in products])
+    await add_to_embedding_matrix(meta, vectors, generation)
+    await publish_catalog_change(generation, [product.id for product in products])
+
+async def add_products_from_db(product_ids: List[str], generation: Optional[int]):
+    """Append products another worker inserted, reading their embeddings from Mongo"""
+    projection = {"_id": 0, "embedding": 1, **{field: 1 for field in _EMB_META_FIELDS}}
+    docs = await db.products.find({"id": {"$in": product_ids}}, projection).to_list(None)
+    if len(docs) != len(product_ids):
+        # Some were deleted in the meantime; let the next search reload everything
+        invalidate_embedding_matrix()
+        return
+    meta = [{field: doc.get(field) for field in _EMB_META_FIELDS} for doc in docs]
+    vectors = np.stack([decode_embedding(doc['embedding']) for doc in docs])
+    await add_to_embedding_matrix(meta, vectors, generation)
+
+async def listen_for_invalidations():
+    """Apply other workers' catalog changes to this worker's embedding matrix"""
+    while True:
+        try:
+            async with redis_client.pubsub() as pubsub:
+                await pubsub.subscribe(INVALIDATE_CHANNEL)
+                async for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    change = json.loads(message['data'])
+                    if change['worker'] == WORKER_ID:
+                        continue
+                    if change['product_ids']:
+                        await add_products_from_db(change['product_ids'], change['generation'])
+                    else:
+                        invalidate_embedding_matrix()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Redis invalidation listener failed: {str(e)}")
+            # Another worker may have written while we were disconnected
+            invalidate_embedding_matrix()
+            await asyncio.sleep(1)
 
 @api_router.get("/")
 async def root():
@@ -102,8 +518,7 @@ async def create_product(product_input: ProductCreate):
     """Create a new product with embedding"""
     try:
         # Generate embedding for product description
-        combined_text = f"{product_input.name}. {product_input.description}. Vibes: {', '.join(product_input.vibe_tags)}"
-        embedding = generate_embedding(combined_text)
+        embedding = normalize_embedding(await asyncio.to_thread(generate_embedding, _embed_text(product_input)))
         
         product = Product(
             name=product_input.name,
@@ -115,9 +530,10 @@ async def create_product(product_input: ProductCreate):
         )
         
         doc = product.model_dump()
-        doc['created_at'] = doc['created_at'].isoformat()
+        doc['embedding'] = encode_embedding(product.embedding)
         
         await db.products.insert_one(doc)
+        await add_products_to_caches([product])
         return product
     except Exception as e:
         logger.error(f"Error creating product: {str(e)}")
@@ -125,13 +541,10 @@ async def create_product(product_input: ProductCreate):
 
 @api_router.get("/products", response_model=List[Product])
 async def get_all_products():
-    """Get all products"""
+    """Get all products (without embeddings)"""
     try:
-        products = await db.products.find({}, {"_id": 0}).to_list(100)
-        for product in products:
-            if isinstance(product.get('created_at'), str):
-                product['created_at'] = datetime.fromisoformat(product['created_at'])
-        return products
+        cursor = db.products.find({}, {"_id": 0, "embedding": 0}).batch_size(CURSOR_BATCH_SIZE)
+        return [product async for product in cursor]
     except Exception as e:
         logger.error(f"Error fetching products: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -143,43 +556,38 @@ async def search_by_vibe(query: VibeQuery):
     
     try:
         # Generate embedding for query
-        query_embedding = generate_embedding(query.vibe)
+        vibe = _normalize_query(query.vibe)
+        query_vec = await get_query_embedding(vibe)
+        query_vec = (query_vec / (np.linalg.norm(query_vec) + 1e-12)).astype(np.float32)
         
-        # Get all products with embeddings
-        products = await db.products.find({}, {"_id": 0}).to_list(100)
+        # Serve repeated or near-duplicate queries from the search cache
+        generation = await get_catalog_generation()
+        results = await get_cached_search(vibe, query_vec, query.limit, query.threshold, generation)
         
-        if not products:
-            return {
-                "results": [],
-                "metrics": {
-                    "query": query.vibe,
-                    "results_count": 0,
-                    "latency_ms": round((time.time() - start_time) * 1000, 2),
-                    "top_score": None,
-                    "message": "No products found. Please add products first."
+        if results is None:
+            # Get the cached product embedding matrix
+            matrix, products, index, generation = await get_embedding_matrix(generation)
+            
+            if not products:
+                return {
+                    "results": [],
+                    "metrics": {
+                        "query": query.vibe,
+                        "results_count": 0,
+                        "latency_ms": round((time.time() - start_time) * 1000, 2),
+                        "top_score": None,
+                        "message": "No products found. Please add products first."
+                    }
                 }
-            }
-        
-        # Calculate similarities
-        results = []
-        for product in products:
-            if product.get('embedding'):
-                similarity = calculate_cosine_similarity(query_embedding, product['embedding'])
-                
-                if similarity >= query.threshold:
-                    results.append({
-                        "id": product['id'],
-                        "name": product['name'],
-                        "description": product['description'],
-                        "vibe_tags": product['vibe_tags'],
-                        "category": product['category'],
-                        "image_url": product.get('image_url'),
-                        "similarity_score": round(similarity, 4)
-                    })
-        
-        # Sort by similarity and limit results
-        results.sort(key=lambda x: x['similarity_score'], reverse=True)
-        results = results[:query.limit]
+            
+            # Rank off the event loop; NumPy releases the GIL during the heavy math
+            results = await asyncio.to_thread(
+                rank_products, query_vec, matrix, products, index, query.limit, query.threshold
+            )
+            
+            # Keyed by the generation the matrix reflects, so a write racing this search can't
+            # leave stale results under the current generation
+            await cache_search(vibe, query_vec, query.limit, query.threshold, results, generation)
         
         latency = round((time.time() - start_time) * 1000, 2)
         
@@ -189,7 +597,7 @@ async def search_by_vibe(query: VibeQuery):
             "results_count": len(results),
             "latency_ms": latency,
             "top_score": results[0]['similarity_score'] if results else None,
-            "timestamp": datetime.now(timezone.utc).isoformat()
+            "timestamp": datetime.now(timezone.utc)
         }
         await db.query_metrics.insert_one(metrics_doc)
         
@@ -213,11 +621,7 @@ async def search_by_vibe(query: VibeQuery):
 async def get_metrics():
     """Get all query metrics"""
     try:
-        metrics = await db.query_metrics.find({}, {"_id": 0}).sort("timestamp", -1).to_list(50)
-        for metric in metrics:
-            if isinstance(metric.get('timestamp'), str):
-                metric['timestamp'] = datetime.fromisoformat(metric['timestamp'])
-        return metrics
+        return await db.query_metrics.find({}, {"_id": 0}).sort("timestamp", -1).to_list(50)
     except Exception as e:
         logger.error(f"Error fetching metrics: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -227,11 +631,37 @@ async def delete_all_products():
     """Delete all products"""
     try:
         result = await db.products.delete_many({})
+        await invalidate_product_caches()
         return {"deleted_count": result.deleted_count}
     except Exception as e:
         logger.error(f"Error deleting products: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@api_router.post("/products/normalize")
+async def normalize_product_embeddings():
+    """Re-normalize stored embeddings and convert them to the binary float16 format"""
+    try:
+        normalized_count = 0
+        ops = []
+        cursor = db.products.find(
+            {"embedding": {"$ne": None}}, {"_id": 0, "id": 1, "embedding": 1}
+        ).batch_size(CURSOR_BATCH_SIZE)
+        async for product in cursor:
+            embedding = normalize_embedding(decode_embedding(product['embedding']))
+            ops.append(UpdateOne({"id": product['id']}, {"$set": {"embedding": encode_embedding(embedding)}}))
+            if len(ops) == CURSOR_BATCH_SIZE:
+                await db.products.bulk_write(ops, ordered=False)
+                normalized_count += len(ops)
+                ops = []
+        if ops:
+            await db.products.bulk_write(ops, ordered=False)
+            normalized_count += len(ops)
+        await invalidate_product_caches()
+        return {"normalized_count": normalized_count}
+    except Exception as e:
+        logger.error(f"Error normalizing embeddings: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @api_router.post("/products/seed")
 async def seed_products():
     """Seed database with sample fashion products"""
@@ -309,32 +739,37 @@ async def seed_products():
     ]
     
     try:
-        created_products = []
-        for product_data in sample_products:
-            product_input = ProductCreate(**product_data)
-            # Generate embedding
-            combined_text = f"{product_input.name}. {product_input.description}. Vibes: {', '.join(product_input.vibe_tags)}"
-            embedding = generate_embedding(combined_text)
-            
+        product_inputs = [ProductCreate(**product_data) for product_data in sample_products]
+        combined_texts = [_embed_text(product_input) for product_input in product_inputs]
+        
+        # Generate embeddings concurrently
+        embeddings = await asyncio.gather(
+            *[asyncio.to_thread(generate_embedding, text) for text in combined_texts]
+        )
+        
+        docs = []
+        products = []
+        for product_input, embedding in zip(product_inputs, embeddings):
             product = Product(
                 name=product_input.name,
                 description=product_input.description,
                 vibe_tags=product_input.vibe_tags,
                 category=product_input.category,
                 image_url=product_input.image_url,
-                embedding=embedding
+                embedding=normalize_embedding(embedding)
             )
             
             doc = product.model_dump()
-            doc['created_at'] = doc['created_at'].isoformat()
-            
-            await db.products.insert_one(doc)
-            created_products.append(product.name)
+            doc['embedding'] = encode_embedding(product.embedding)
+            docs.append(doc)
+            products.append(product)
         
+        await db.products.insert_many(docs)
+        await add_products_to_caches(products)
         return {
             "message": "Products seeded successfully",
-            "count": len(created_products),
-            "products": created_products
+            "count": len(products),
+            "products": [product.name for product in products]
         }
     except Exception as e:
         logger.error(f"Error seeding products: {str(e)}")
@@ -350,6 +785,24 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def create_indexes():
+    await db.query_metrics.create_index([("timestamp", -1)])
+    await db.products.create_index("id", unique=True)
+
+@app.on_event("startup")
+async def start_invalidation_listener():
+    global _invalidation_task
+    if redis_client is not None:
+        _invalidation_task = asyncio.create_task(listen_for_invalidations())
+    else:
+        logger.info("REDIS_URL not set: search results are not cached and workers pick up "
+                    "other workers' product changes by reloading on the next search")
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    client.close()
+    if _invalidation_task is not None:
+        _invalidation_task.cancel()
+    if redis_client is not None:
+        await redis_client.aclose()
\ No newline at end of file